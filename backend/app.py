@@ -1,23 +1,37 @@
 import os
-import io
+import asyncio
 import re
-import json
-from typing import Optional, Dict, Any, List
+import copy
+import time
+import hashlib
+import datetime
+import threading
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator
 
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
-
-from PyPDF2 import PdfReader
-from pdfminer.high_level import extract_text as pdfminer_extract_text
-from bs4 import BeautifulSoup
+import orjson
 
 import google.generativeai as genai
+from google.generativeai import client as genai_client
+from google.generativeai.types import generation_types
+
+from text_extraction import clean_email_text, clean_email_texts, extract_file_content, read_file_bytes_to_text
 
 load_dotenv()
 
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger("app")
+
 # ============================== Config Gemini ==============================
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 if not GOOGLE_API_KEY:
@@ -25,7 +39,25 @@ if not GOOGLE_API_KEY:
 
 genai.configure(api_key=GOOGLE_API_KEY)
 GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-1.5-flash")
-MODEL = genai.GenerativeModel(model_name=GEMINI_MODEL)
+# Cache de contexto (instruções + few-shots) é opt-in: exige modelo versionado (ex.: gemini-1.5-flash-001)
+# e um prefixo acima do mínimo de tokens cacheáveis da API, o que o prompt atual não atinge
+GEMINI_CONTEXT_CACHE = os.environ.get("GEMINI_CONTEXT_CACHE", "0") == "1"
+CACHE_TTL = datetime.timedelta(hours=1)
+# Limite de chamadas simultâneas ao Gemini no processo todo (respeita a cota de QPS)
+GEMINI_CONCURRENCY = int(os.environ.get("GEMINI_CONCURRENCY", "8"))
+# Tamanho máximo por arquivo enviado (mesmo limite de payload do Gemini)
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+UPLOAD_CHUNK_BYTES = 64 * 1024
+# Processos para trabalho de CPU em Python puro que segura o GIL (PDF, limpeza de lotes grandes)
+# Padrão baixo: em contêiner cpu_count() é o do host, e com fork todos os workers sobem de uma vez
+_available_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", min(_available_cpus, 4)))
+# A partir de quantos textos a limpeza do lote compensa o envio ao pool de processos
+CLEAN_POOL_MIN_ITEMS = 64
+# Cache de respostas do Gemini por e-mail limpo (LRU); FUZZY_CACHE=1 liga o casamento aproximado
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "4096"))
+FUZZY_CACHE = os.environ.get("FUZZY_CACHE", "0") == "1"
+FUZZY_MAX_DISTANCE = int(os.environ.get("FUZZY_MAX_DISTANCE", "3"))
 
 # ============================== Schema (JSON) ==============================
 EMAIL_JSON_SCHEMA = {
@@ -104,97 +136,111 @@ FEW_SHOTS = [
     },
 ]
 
-# ============================== Limpeza de e-mail ==============================
-HEADER_RE = re.compile(r"^(from|de|to|para|subject|assunto|date|data|cc|bcc|reply-to|message-id|received)\s*:", re.I)
-
-def strip_html(text: str) -> str:
-    return BeautifulSoup(text, "html.parser").get_text(" ", strip=True)
+# ============================== Modelo (context caching) ==============================
+CACHED_PROMPT_PREFIX = (
+    f"Analise este e-mail e responda SOMENTE JSON válido conforme o schema:\n"
+    f"E-mail:\n-----\n"
+)
 
-def clean_email_text(raw: str) -> str:
-    """Limpa e normaliza texto de e-mail removendo ruídos e formatação desnecessária."""
-    if not raw or not isinstance(raw, str):
-        return ""
-    
-    # Remover HTML se presente
-    if "<html" in raw.lower() or "<div" in raw.lower() or "<br" in raw.lower():
-        raw = strip_html(raw)
-    
-    lines = []
-    for line in raw.splitlines():
-        line = line.strip()
-        if not line:
-            continue
-        if HEADER_RE.match(line):
-            continue
-        # Pular citações
-        if line.startswith(">"):
-            continue
-        if len(line) < 3:
-            continue
-        lines.append(line)
-    
-    if not lines:
-        return ""
-    
-    text = " ".join(lines)
-    text = re.sub(r"https?://\S+", " ", text)
-    text = re.sub(r"[^\w\s\-.,!?;:()]", " ", text)
-    text = re.sub(r"\s{2,}", " ", text)
-    text = text.strip()
-    
-    if len(text) < 10:
-        return ""
-    
-    return text
+def few_shot_turns() -> List[Dict[str, Any]]:
+    """Few-shots como turnos user/model, no mesmo formato do sufixo enviado por requisição."""
+    turns = []
+    for ex in FEW_SHOTS:
+        turns.append({"role": "user", "parts": [f"{CACHED_PROMPT_PREFIX}{ex['email']}\n-----\n"]})
+        turns.append({"role": "model", "parts": [orjson.dumps(ex["json"]).decode()]})
+    return turns
 
-# ============================== PDF (.pdf) ==============================
-def read_pdf(data: bytes) -> str:
-    """Lê PDF usando múltiplas estratégias para máxima compatibilidade."""
-    content = ""
-    
-    try:
-        reader = PdfReader(io.BytesIO(data))
-        content = "".join((page.extract_text() or "") for page in reader.pages)
-        if content.strip():
-            print("PDF lido com sucesso usando PyPDF2")
-            return content
-    except Exception as e:
-        print(f"PyPDF2 falhou: {str(e)}")
-    
-    try:
-        content = pdfminer_extract_text(io.BytesIO(data)) or ""
-        if content.strip():
-            print("PDF lido com sucesso usando pdfminer")
-            return content
-    except Exception as e:
-        print(f"pdfminer falhou: {str(e)}")
-    
+def create_model():
+    """Registra instruções + few-shots no cache de contexto do Gemini; sem cache, usa o prompt completo."""
+    if not GEMINI_CONTEXT_CACHE:
+        return None, genai.GenerativeModel(model_name=GEMINI_MODEL)
     try:
-        text_content = data.decode('utf-8', errors='ignore')
-        if text_content and len(text_content.strip()) > 100:
-            print("PDF decodificado como texto UTF-8")
-            return text_content
-    except Exception as e:
-        print(f"Decodificação UTF-8 falhou: {str(e)}")
-    
-    try:
-        text_content = data.decode('latin-1', errors='ignore')
-        if text_content and len(text_content.strip()) > 100:
-            print("PDF decodificado como texto Latin-1")
-            return text_content
+        cache = genai.caching.CachedContent.create(
+            model=GEMINI_MODEL,
+            display_name="intentionmail-prefix",
+            system_instruction=SYSTEM_INSTRUCTIONS,
+            contents=few_shot_turns(),
+            ttl=CACHE_TTL,
+        )
+        logger.info("Cache de contexto criado: %s", cache.name)
+        return cache, genai.GenerativeModel.from_cached_content(cached_content=cache)
     except Exception as e:
-        print(f"Decodificação Latin-1 falhou: {str(e)}")
-    
-    print("Todas as estratégias de leitura de PDF falharam")
-    return ""
+        logger.warning("Cache de contexto indisponível, usando prompt completo: %s", e)
+        return None, genai.GenerativeModel(model_name=GEMINI_MODEL)
+
+# (cache, modelo) num único par para que as leituras nunca misturem gerações diferentes
+MODEL_STATE = create_model()
+_cache_expires_at = time.monotonic() + CACHE_TTL.total_seconds()
+_model_lock = threading.Lock()
+
+def cache_expiring() -> bool:
+    return MODEL_STATE[0] is not None and time.monotonic() >= _cache_expires_at - 60
 
-def read_file_bytes_to_text(filename: str, data: bytes) -> str:
-    if filename.lower().endswith(".pdf"):
-        return read_pdf(data)
+def get_model():
+    """Devolve (cache, modelo), recriando o cache um pouco antes de o TTL expirar."""
+    global MODEL_STATE, _cache_expires_at
+    if cache_expiring():
+        with _model_lock:
+            if cache_expiring():
+                MODEL_STATE = create_model()
+                _cache_expires_at = time.monotonic() + CACHE_TTL.total_seconds()
+    return MODEL_STATE
+
+# ============================== Pool de processos ==============================
+# Workers nascem de um forkserver (ou spawn) e importam só text_extraction, que não tem efeitos
+# colaterais; evita fork de um processo já cheio de threads (AnyIO, gRPC) e reimportar o app.
+if "forkserver" in multiprocessing.get_all_start_methods():
+    CPU_MP_CONTEXT = multiprocessing.get_context("forkserver")
+    CPU_MP_CONTEXT.set_forkserver_preload(["text_extraction"])
+else:
+    CPU_MP_CONTEXT = multiprocessing.get_context("spawn")
+
+CPU_POOL = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=CPU_MP_CONTEXT)
+
+def replace_pool(pool: ProcessPoolExecutor) -> None:
+    global CPU_POOL
+    if CPU_POOL is pool:
+        CPU_POOL = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=CPU_MP_CONTEXT)
+
+async def run_in_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    pool = CPU_POOL
     try:
-        return data.decode("utf-8", errors="ignore")
-    except Exception:
-        return data.decode("latin-1", errors="ignore")
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # Um worker que morre (ex.: PDF corrompido derrubou o PDFium) quebra o pool e todas as
+        # tarefas em andamento nele. Cada tarefa afetada roda de novo sozinha num pool
+        # descartável: se ela mesma derruba o worker, só ela falha.
+        replace_pool(pool)
+        isolated = ProcessPoolExecutor(max_workers=1, mp_context=CPU_MP_CONTEXT)
+        try:
+            return await loop.run_in_executor(isolated, func, *args)
+        finally:
+            isolated.shutdown(wait=False)
+
+async def run_extraction(func, filename: str, data: bytes):
+    """PDFs vão para o pool de processos, fora do GIL; .txt é barato e fica no threadpool."""
+    if not filename.lower().endswith(".pdf"):
+        return await run_in_threadpool(func, filename, data)
+    return await run_in_pool(func, filename, data)
+
+async def clean_texts(texts: List[str]) -> List[str]:
+    """Lotes pequenos são limpos direto; os grandes são divididos entre os processos do pool."""
+    if len(texts) < CLEAN_POOL_MIN_ITEMS or CPU_WORKERS < 2:
+        return clean_email_texts(texts)
+    size = -(-len(texts) // CPU_WORKERS)
+    parts = [texts[i:i+size] for i in range(0, len(texts), size)]
+    chunks = await asyncio.gather(
+        *(run_in_pool(clean_email_texts, part) for part in parts), return_exceptions=True
+    )
+    cleaned = []
+    for part, chunk in zip(parts, chunks):
+        if isinstance(chunk, Exception):
+            # Pool indisponível: limpa este pedaço aqui mesmo em vez de derrubar o lote
+            logger.warning("Limpeza no pool falhou, limpando localmente: %s", chunk)
+            chunk = await run_in_threadpool(clean_email_texts, part)
+        cleaned.extend(chunk)
+    return cleaned
 
 # ============================== Prompt builder ==============================
 def normalize_intent(v: str) -> str:
@@ -205,41 +251,134 @@ def normalize_intent(v: str) -> str:
     v = mapping.get(v, v)
     return v if v in {"status","anexo","suporte","dúvida","felicitações","agradecimento","outros"} else "outros"
 
-def build_user_prompt(email_text: str) -> str:
-    few = "\n\n".join(
-        f"Exemplo {i+1}:\nE-mail:\n{ex['email']}\nJSON:\n{json.dumps(ex['json'], ensure_ascii=False)}"
-        for i, ex in enumerate(FEW_SHOTS)
-    )
-    return (
-        f"{SYSTEM_INSTRUCTIONS}\n\n"
-        f"{few}\n\n"
-        f"Agora, analise este e-mail e responda SOMENTE JSON válido conforme o schema:\n"
-        f"E-mail:\n-----\n{email_text}\n-----\n"
-    )
+# Prefixos estáticos montados uma única vez; por requisição só o e-mail é concatenado.
+FEW_SHOT_BLOCK = "\n\n".join(
+    f"Exemplo {i+1}:\nE-mail:\n{ex['email']}\nJSON:\n{orjson.dumps(ex['json']).decode()}"
+    for i, ex in enumerate(FEW_SHOTS)
+)
+PROMPT_PREFIX = (
+    f"{SYSTEM_INSTRUCTIONS}\n\n"
+    f"{FEW_SHOT_BLOCK}\n\n"
+    f"Agora, analise este e-mail e responda SOMENTE JSON válido conforme o schema:\n"
+    f"E-mail:\n-----\n"
+)
+
+def build_user_prompt(email_text: str, cached: bool = False) -> str:
+    # Com cache de contexto, instruções e few-shots já estão no modelo: envia só o sufixo.
+    prefix = CACHED_PROMPT_PREFIX if cached else PROMPT_PREFIX
+    return f"{prefix}{email_text}\n-----\n"
 
 def parse_json_strict(text: str) -> Dict[str, Any]:
+    # Com response_mime_type="application/json" o Gemini devolve JSON puro: carrega direto.
+    try:
+        data = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        return parse_json_legacy(text)
+    # JSON válido mas não-objeto (ex.: [{...}]): recorta o objeto como antes
+    return data if isinstance(data, dict) else parse_json_legacy(text)
+
+def parse_json_legacy(text: str) -> Dict[str, Any]:
+    """Recorta o JSON entre a primeira '{' e a última '}' (respostas com texto extra)."""
     start, end = text.find("{"), text.rfind("}")
     if start == -1 or end == -1 or end <= start:
         raise ValueError("Resposta não contém JSON.")
-    return json.loads(text[start:end+1])
-
-def classify_with_gemini(email_text: str) -> Dict[str, Any]:
-    prompt = [{"role": "user", "parts": [build_user_prompt(email_text)]}]
-    resp = MODEL.generate_content(
-        prompt,
-        generation_config=genai.types.GenerationConfig(
-            response_mime_type="application/json",
-            response_schema=EMAIL_JSON_SCHEMA,
-            temperature=0.2,
-            max_output_tokens=512
-        )
+    return orjson.loads(text[start:end+1])
+
+GENERATION_CONFIG = genai.types.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=EMAIL_JSON_SCHEMA,
+    temperature=0.2,
+    max_output_tokens=512
+)
+
+class JsonObjectScanner:
+    """Acompanha o JSON recebido em pedaços e avisa quando o objeto de topo fecha."""
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, chunk: str) -> bool:
+        for ch in chunk:
+            if self.in_string:
+                # Chaves dentro de strings (ex.: no suggested_reply) não contam
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+        return False
+
+async def open_gemini_stream(model, prompt):
+    """Mesmo caminho de generate_content_async(stream=True), mas devolvendo também a chamada gRPC.
+
+    O SDK esconde a chamada atrás de aiter(), que não tem cancel(); fechar só os geradores deixa o
+    stream aberto até o GC. Depende de partes privadas do google-generativeai 0.7.2 (fixado em
+    requirements.txt): _prepare_request e _async_client.
+    """
+    request = model._prepare_request(
+        contents=prompt, generation_config=GENERATION_CONFIG, tools=None, tool_config=None
     )
-    output_text = getattr(resp, "text", None)
-    if not output_text:
-        try: output_text = resp.candidates[0].content.parts[0].text
-        except Exception: raise RuntimeError("Não foi possível ler a resposta do Gemini.")
+    if model._async_client is None:
+        model._async_client = genai_client.get_default_generative_async_client()
+    with generation_types.rewrite_stream_error():
+        call = await model._async_client.stream_generate_content(request)
+    try:
+        resp = await generation_types.AsyncGenerateContentResponse.from_aiterator(call)
+    except BaseException:
+        call.cancel()
+        raise
+    return call, resp
+
+async def stream_gemini_text(email_text: str) -> AsyncIterator[str]:
+    """Repassa o texto do Gemini em streaming, parando assim que o JSON estiver completo."""
+    # Recriar o cache é uma chamada bloqueante: só nesse caso sai do event loop
+    cache, model = await run_in_threadpool(get_model) if cache_expiring() else MODEL_STATE
+    prompt = [{"role": "user", "parts": [build_user_prompt(email_text, cached=cache is not None)]}]
+    call, resp = await open_gemini_stream(model, prompt)
+    scanner = JsonObjectScanner()
+    chunks = aiter(resp)
+    try:
+        async for chunk in chunks:
+            text = chunk_text(chunk)
+            if not text:
+                continue
+            yield text
+            if scanner.feed(text):
+                break
+    finally:
+        # Após o break (ou erro) o stream ficaria aberto até o GC: fecha a iteração e cancela a
+        # chamada gRPC; cancel() numa chamada já concluída não faz nada
+        await chunks.aclose()
+        call.cancel()
+
+def chunk_text(chunk) -> str:
+    """Texto de um pedaço do stream; "" se não tiver partes, erro se o Gemini bloqueou/interrompeu."""
+    if not chunk.candidates:
+        block_reason = getattr(chunk.prompt_feedback, "block_reason", None)
+        if block_reason:
+            raise RuntimeError(f"Gemini bloqueou o prompt: {getattr(block_reason, 'name', block_reason)}")
+        return ""
+    candidate = chunk.candidates[0]
+    parts = candidate.content.parts
+    if parts:
+        return "".join(part.text for part in parts)
+    finish_reason = getattr(candidate.finish_reason, "name", str(candidate.finish_reason))
+    if finish_reason in {"FINISH_REASON_UNSPECIFIED", "STOP"}:
+        return ""  # pedaço só com metadados de término
+    raise RuntimeError(f"Gemini interrompeu a resposta: {finish_reason}")
 
-    data = parse_json_strict(output_text)
+def normalize_result(data: Dict[str, Any]) -> Dict[str, Any]:
     category = data.get("category", "Improdutivo")
     if category not in {"Produtivo","Improdutivo"}: category = "Improdutivo"
     intent = normalize_intent(data.get("intent"))
@@ -248,8 +387,144 @@ def classify_with_gemini(email_text: str) -> Dict[str, Any]:
     return {"category": category, "confidence": conf,
             "suggested_reply": reply, "metadata": {"intent": intent}}
 
+async def call_gemini(email_text: str) -> Dict[str, Any]:
+    output_text = "".join([text async for text in stream_gemini_text(email_text)])
+    if not output_text:
+        raise RuntimeError("Não foi possível ler a resposta do Gemini.")
+    return normalize_result(parse_json_strict(output_text))
+
+_gemini_limiter: Optional[asyncio.Semaphore] = None
+
+def gemini_limiter() -> asyncio.Semaphore:
+    """Semáforo único para todas as requisições, criado já dentro do event loop."""
+    global _gemini_limiter
+    if _gemini_limiter is None:
+        _gemini_limiter = asyncio.Semaphore(GEMINI_CONCURRENCY)
+    return _gemini_limiter
+
+# ============================== Cache de respostas ==============================
+_response_cache: "OrderedDict[bytes, Tuple[Optional[int], Dict[str, Any]]]" = OrderedDict()
+_response_lock = threading.Lock()
+
+def email_key(email_text: str) -> bytes:
+    return hashlib.blake2b(email_text.encode("utf-8"), digest_size=16).digest()
+
+def simhash(email_text: str) -> int:
+    """SimHash de 64 bits sobre trigramas de palavras: textos quase iguais ficam a poucos bits."""
+    words = email_text.lower().split()
+    weights = [0] * 64
+    for i in range(max(len(words) - 2, 1)):
+        shingle = " ".join(words[i:i+3]).encode("utf-8")
+        h = int.from_bytes(hashlib.blake2b(shingle, digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+def cache_get(key: bytes, fingerprint: Optional[int]) -> Optional[Dict[str, Any]]:
+    with _response_lock:
+        entry = _response_cache.get(key)
+        if entry is None and fingerprint is not None:
+            for k, (fp, _) in _response_cache.items():
+                if fp is not None and bin(fp ^ fingerprint).count("1") <= FUZZY_MAX_DISTANCE:
+                    key, entry = k, _response_cache[k]
+                    break
+        if entry is None:
+            return None
+        _response_cache.move_to_end(key)
+        # Cópia: quem chama pode alterar o resultado (ex.: analyze_batch adiciona "id")
+        return copy.deepcopy(entry[1])
+
+def cache_put(key: bytes, fingerprint: Optional[int], result: Dict[str, Any]) -> None:
+    with _response_lock:
+        _response_cache[key] = (fingerprint, copy.deepcopy(result))
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+def cache_lookup(email_text: str) -> Tuple[Tuple[bytes, Optional[int]], Optional[Dict[str, Any]]]:
+    """Chave do e-mail no cache de respostas e o resultado já guardado (ou None).
+
+    Único ponto de consulta usado por /api/analyze(_batch) e /api/analyze_stream; a chave
+    devolvida vai para cache_put(*key, result).
+    """
+    key = (email_key(email_text), simhash(email_text) if FUZZY_CACHE else None)
+    return key, cache_get(*key)
+
+async def classify_with_gemini(email_text: str) -> Dict[str, Any]:
+    key, cached = cache_lookup(email_text)
+    if cached is not None:
+        return cached
+    async with gemini_limiter():
+        result = await call_gemini(email_text)
+    cache_put(*key, result)
+    return result
+
+CATEGORY_RE = re.compile(r'"category"\s*:\s*"(Produtivo|Improdutivo)"')
+
+def sse_event(event: str, data: Dict[str, Any]) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+async def stream_classification(email_text: str) -> AsyncIterator[bytes]:
+    """Eventos SSE: "category" assim que a categoria aparece no stream, depois "result" (ou "error")."""
+    key, cached = cache_lookup(email_text)
+    if cached is not None:
+        yield sse_event("result", cached)
+        return
+
+    output_text = ""
+    category_sent = False
+    try:
+        async with gemini_limiter():
+            async for text in stream_gemini_text(email_text):
+                output_text += text
+                if not category_sent and (m := CATEGORY_RE.search(output_text)):
+                    category_sent = True
+                    yield sse_event("category", {"category": m.group(1)})
+        result = normalize_result(parse_json_strict(output_text))
+    except Exception as e:
+        logger.warning("Erro ao processar e-mail em streaming: %s", e)
+        yield sse_event("error", {"detail": f"Erro ao processar: {str(e)}"})
+        return
+    cache_put(*key, result)
+    yield sse_event("result", result)
+
+# ============================== Upload ==============================
+async def read_upload(file: UploadFile) -> bytes:
+    """Lê o upload em blocos, abortando com 413 assim que passar de MAX_UPLOAD_BYTES."""
+    buf = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+        buf.extend(chunk)
+        if len(buf) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Arquivo maior que 10MB.")
+    return bytes(buf)
+
+async def read_request_content(text: Optional[str], file: Optional[UploadFile]) -> str:
+    """Texto limpo de /api/analyze(_stream): vem do campo 'text' ou de um .txt/.pdf enviado."""
+    if not text and not file:
+        raise HTTPException(status_code=400, detail="Envie um texto ou um arquivo .txt/.pdf.")
+    if file is not None:
+        filename = file.filename or ""
+        if not filename.lower().endswith((".pdf",".txt")):
+            raise HTTPException(status_code=415, detail="Formato não suportado. Envie .txt ou .pdf.")
+        data = await read_upload(file)
+        try:
+            raw = await run_extraction(read_file_bytes_to_text, filename, data)
+        except BrokenProcessPool:
+            raise HTTPException(status_code=422, detail="Não foi possível extrair o texto do PDF.")
+    else:
+        raw = text or ""
+    content = clean_email_text(raw)
+    if not content:
+        raise HTTPException(status_code=400, detail="Conteúdo vazio.")
+    return content
+
 # ============================== FastAPI ==============================
-app = FastAPI(title="Email Analyzer - Gemini Flash", version="3.2.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    CPU_POOL.shutdown(cancel_futures=True)
+
+app = FastAPI(title="Email Analyzer - Gemini Flash", version="3.2.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -265,22 +540,19 @@ def health():
 
 @app.post("/api/analyze")
 async def analyze(text: Optional[str] = Form(None), file: Optional[UploadFile] = File(None)):
-    if not text and not file:
-        raise HTTPException(status_code=400, detail="Envie um texto ou um arquivo .txt/.pdf.")
-    if file is not None:
-        filename = file.filename or ""
-        data = await file.read()
-        if not filename.lower().endswith((".pdf",".txt")):
-            raise HTTPException(status_code=415, detail="Formato não suportado. Envie .txt ou .pdf.")
-        raw = read_file_bytes_to_text(filename, data)
-    else:
-        raw = text or ""
-    content = clean_email_text(raw)
-    if not content:
-        raise HTTPException(status_code=400, detail="Conteúdo vazio.")
-    result = await run_in_threadpool(classify_with_gemini, content)
+    content = await read_request_content(text, file)
+    result = await classify_with_gemini(content)
     return JSONResponse(result)
 
+@app.post("/api/analyze_stream")
+async def analyze_stream(text: Optional[str] = Form(None), file: Optional[UploadFile] = File(None)):
+    content = await read_request_content(text, file)
+    return StreamingResponse(
+        stream_classification(content),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
 @app.post("/api/analyze_batch")
 async def analyze_batch(
     texts: Optional[str] = Form(None), 
@@ -290,7 +562,7 @@ async def analyze_batch(
     
     if texts:
         try:
-            arr = json.loads(texts)
+            arr = orjson.loads(texts)
             if not isinstance(arr, list):
                 raise ValueError("Campo 'texts' deve ser uma lista")
         except Exception as e:
@@ -299,34 +571,41 @@ async def analyze_batch(
                 detail=f"Campo 'texts' deve ser JSON válido (lista de strings). Erro: {str(e)}"
             )
         
-        for i, t in enumerate(arr):
-            if isinstance(t, str) and t.strip():
-                items.append({"id": f"text-{i}", "content": clean_email_text(t)})
+        valid = [(i, t) for i, t in enumerate(arr) if isinstance(t, str) and t.strip()]
+        cleaned = await clean_texts([t for _, t in valid])
+        for (i, _), content in zip(valid, cleaned):
+            items.append({"id": f"text-{i}", "content": content})
     
     if files:
+        uploads = []
         for i, f in enumerate(files):
-            try:
-                name = f.filename or f"file-{i}"
-                if not name.lower().endswith((".pdf", ".txt")):
-                    continue
-                
-                data = await f.read()
-                if not data:
-                    continue
-                    
-                content = read_file_bytes_to_text(name, data)
-                if content:
-                    cleaned_content = clean_email_text(content)
-                    if cleaned_content:
-                        items.append({"id": name, "content": cleaned_content})
-                    else:
-                        print(f"Arquivo {name} não gerou conteúdo válido após limpeza")
-                else:
-                    print(f"Arquivo {name} não pôde ser lido")
-                    
-            except Exception as e:
-                print(f"Erro ao processar arquivo {f.filename}: {str(e)}")
-                continue
+            name = f.filename or f"file-{i}"
+            if name.lower().endswith((".pdf", ".txt")):
+                uploads.append((name, f))
+
+        # Lê e valida o tamanho de todos os uploads antes de qualquer extração: um 413 sai sem parsear PDF
+        datas = await asyncio.gather(*(read_upload(f) for _, f in uploads), return_exceptions=True)
+        for data in datas:
+            if isinstance(data, HTTPException):
+                raise data
+
+        readable = []
+        for (name, _), data in zip(uploads, datas):
+            if isinstance(data, Exception):
+                logger.warning("Erro ao ler arquivo %s: %s", name, data)
+            elif data:
+                readable.append((name, data))
+
+        # Extração (PDF) + limpeza fora do event loop, sobrepondo os arquivos entre si
+        contents = await asyncio.gather(
+            *(run_extraction(extract_file_content, name, data) for name, data in readable),
+            return_exceptions=True
+        )
+        for (name, _), content in zip(readable, contents):
+            if isinstance(content, Exception):
+                logger.warning("Erro ao processar arquivo %s: %s", name, content)
+            elif content:
+                items.append({"id": name, "content": content})
     
     if not items:
         raise HTTPException(
@@ -334,22 +613,26 @@ async def analyze_batch(
             detail="Nenhum item válido para analisar. Verifique se os arquivos são .txt/.pdf válidos e contêm texto."
         )
     
-    print(f"Processando {len(items)} itens: {[item['id'] for item in items]}")
+    logger.info("Processando %d itens", len(items))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Itens do lote: %s", ", ".join(item["id"] for item in items))
     
-    results = []
-    for item in items:
+    # A concorrência com o Gemini é limitada por gemini_limiter(), compartilhado entre requisições
+    async def classify_item(item: Dict[str, Any]) -> Dict[str, Any]:
         try:
-            result = await run_in_threadpool(classify_with_gemini, item["content"])
+            result = await classify_with_gemini(item["content"])
             result["id"] = item["id"]
-            results.append(result)
+            return result
         except Exception as e:
-            print(f"Erro ao processar item {item['id']}: {str(e)}")
-            results.append({
+            logger.warning("Erro ao processar item %s: %s", item["id"], e)
+            return {
                 "id": item["id"],
                 "category": "Improdutivo",
                 "confidence": 0.0,
                 "suggested_reply": f"Erro ao processar: {str(e)}",
                 "metadata": {"intent": "outros"}
-            })
+            }
+
+    results = await asyncio.gather(*(classify_item(item) for item in items))
     
     return JSONResponse({"count": len(results), "results": results})
@@ -0,0 +1,150 @@
+"""Extração e limpeza de texto de e-mails (.txt/.pdf/HTML).
+
+Roda dentro dos processos do CPU_POOL de app.py, então não pode ter efeitos colaterais
+no import (sem configuração do Gemini, variáveis obrigatórias ou chamadas de rede).
+"""
+import io
+import re
+import threading
+import functools
+import logging
+from typing import List
+
+import pypdfium2
+from pdfminer.high_level import extract_text as pdfminer_extract_text
+from bs4 import BeautifulSoup
+from selectolax.parser import HTMLParser
+
+logger = logging.getLogger("app.extraction")
+
+# ============================== Limpeza de e-mail ==============================
+HEADER_RE = re.compile(r"^(from|de|to|para|subject|assunto|date|data|cc|bcc|reply-to|message-id|received)\s*:", re.I)
+CLEAN_CACHE_SIZE = 1024
+# Só textos curtos (templates, respostas automáticas): pior caso ~1024 x 2 x 4k chars por processo
+CLEAN_CACHE_MAX_CHARS = 4_000
+# Prefiltro barato (str.startswith em C) antes do regex: a maioria das linhas é corpo e não casa
+HEADER_PREFIXES = ("from", "de", "to", "para", "subject", "assunto", "date", "data",
+                   "cc", "bcc", "reply-to", "message-id", "received")
+HTML_SNIFF_RE = re.compile(r"<(?:html|div|br)", re.I)
+URL_RE = re.compile(r"https?://\S+")
+PUNCT_RE = re.compile(r"[^\w\s\-.,!?;:()]")
+WS_RE = re.compile(r"\s{2,}")
+
+def is_header_line(line: str) -> bool:
+    return line[:10].lower().startswith(HEADER_PREFIXES) and HEADER_RE.match(line) is not None
+
+def keep_line(line: str) -> bool:
+    """Linha já aparada: descarta vazias/curtas, citações (">") e cabeçalhos."""
+    return len(line) >= 3 and line[0] != ">" and not is_header_line(line)
+
+def strip_html(text: str) -> str:
+    try:
+        tree = HTMLParser(text)
+        # Igual ao get_text do BeautifulSoup: sem script/style/template e incluindo o <head> (ex.: <title>)
+        tree.strip_tags(["script", "style", "template"])
+        return tree.root.text(separator=" ", strip=True) if tree.root is not None else ""
+    except Exception as e:
+        logger.warning("selectolax falhou, usando BeautifulSoup: %s", e)
+        return BeautifulSoup(text, "html.parser").get_text(" ", strip=True)
+
+def clean_email_text(raw: str) -> str:
+    """Limpa e normaliza texto de e-mail removendo ruídos e formatação desnecessária."""
+    if not raw or not isinstance(raw, str):
+        return ""
+    # Limpeza é determinística: textos repetidos saem do cache; os muito grandes não entram nele
+    if len(raw) < CLEAN_CACHE_MAX_CHARS:
+        return cached_clean_email_body(raw)
+    return clean_email_body(raw)
+
+def clean_email_body(raw: str) -> str:
+    # Remover HTML se presente
+    if HTML_SNIFF_RE.search(raw):
+        raw = strip_html(raw)
+    
+    # Passada única: cada linha é aparada uma vez e filtrada direto no join
+    stripped = (line.strip() for line in raw.splitlines())
+    text = " ".join(line for line in stripped if keep_line(line))
+    if not text:
+        return ""
+    
+    text = URL_RE.sub(" ", text)
+    text = PUNCT_RE.sub(" ", text)
+    text = WS_RE.sub(" ", text)
+    text = text.strip()
+    
+    if len(text) < 10:
+        return ""
+    
+    return text
+
+cached_clean_email_body = functools.lru_cache(maxsize=CLEAN_CACHE_SIZE)(clean_email_body)
+
+# ============================== PDF (.pdf) ==============================
+# PDFium não é thread-safe (nem entre documentos diferentes): no máximo uma thread por processo o usa
+PDFIUM_LOCK = threading.Lock()
+
+def read_pdf(data: bytes) -> str:
+    """Lê PDF usando múltiplas estratégias para máxima compatibilidade."""
+    content = ""
+    
+    try:
+        with PDFIUM_LOCK:
+            pdf = pypdfium2.PdfDocument(io.BytesIO(data))
+            try:
+                content = "".join(page.get_textpage().get_text_range() for page in pdf)
+            finally:
+                pdf.close()
+        if content.strip():
+            logger.debug("PDF lido com sucesso usando pypdfium2")
+            return content
+    except Exception as e:
+        logger.debug("pypdfium2 falhou: %s", e)
+    
+    try:
+        content = pdfminer_extract_text(io.BytesIO(data)) or ""
+        if content.strip():
+            logger.debug("PDF lido com sucesso usando pdfminer")
+            return content
+    except Exception as e:
+        logger.debug("pdfminer falhou: %s", e)
+    
+    try:
+        text_content = data.decode('utf-8', errors='ignore')
+        if text_content and len(text_content.strip()) > 100:
+            logger.debug("PDF decodificado como texto UTF-8")
+            return text_content
+    except Exception as e:
+        logger.debug("Decodificação UTF-8 falhou: %s", e)
+    
+    try:
+        text_content = data.decode('latin-1', errors='ignore')
+        if text_content and len(text_content.strip()) > 100:
+            logger.debug("PDF decodificado como texto Latin-1")
+            return text_content
+    except Exception as e:
+        logger.debug("Decodificação Latin-1 falhou: %s", e)
+    
+    logger.warning("Todas as estratégias de leitura de PDF falharam")
+    return ""
+
+def read_file_bytes_to_text(filename: str, data: bytes) -> str:
+    if filename.lower().endswith(".pdf"):
+        return read_pdf(data)
+    try:
+        return data.decode("utf-8", errors="ignore")
+    except Exception:
+        return data.decode("latin-1", errors="ignore")
+
+def extract_file_content(filename: str, data: bytes) -> str:
+    """Extrai e limpa o texto de um arquivo enviado; devolve "" se não houver conteúdo útil."""
+    content = read_file_bytes_to_text(filename, data)
+    if not content:
+        logger.info("Arquivo %s não pôde ser lido", filename)
+        return ""
+    cleaned_content = clean_email_text(content)
+    if not cleaned_content:
+        logger.info("Arquivo %s não gerou conteúdo válido após limpeza", filename)
+    return cleaned_content
+
+def clean_email_texts(texts: List[str]) -> List[str]:
+    return [clean_email_text(t) for t in texts]